@@ -4,15 +4,19 @@ from typing import List
 
 class Helper:
     @staticmethod
-    def get_output_path(topic_ids: List[str]) -> str:
-        """Get the output Excel file path.
+    def get_output_path(topic_ids: List[str], ext: str = "csv") -> str:
+        """Get the output file path.
+
+        Args:
+            topic_ids: Topic IDs the output file contains notes for
+            ext: Output file extension (csv, tsv or xlsx)
 
         Returns:
-            Output Excel file path
+            Output file path
         """
         current_time = datetime.now() 
         timestamp = current_time.strftime("%Y%m%d_%H%M%S")
-        excel_file_name = f"{'_'.join(topic_ids)}_notes_{timestamp}.xlsx"
+        file_name = f"{'_'.join(topic_ids)}_notes_{timestamp}.{ext}"
         ouput_directory = "output"
-        output_path = f"{ouput_directory}/{excel_file_name}"
+        output_path = f"{ouput_directory}/{file_name}"
         return output_path
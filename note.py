@@ -1,15 +1,24 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
 
-class Note(BaseModel):
-    note: str = Field(alias="n_ans")
-    note_images: Optional[List[str]] = Field(default=None, alias="n_imgs")
+@dataclass(slots=True, frozen=True)
+class Note:
+    note: str
+    note_images: Optional[Tuple[str, ...]] = None
+    images: str = field(init=False, repr=False)
     
-    @property
-    def images(self):
-        return ", ".join(self.note_images) if self.note_images else ""
+    def __post_init__(self):
+        # Joined once here so repeated reads of images are free; object.__setattr__
+        # because the dataclass is frozen
+        images = ", ".join(self.note_images) if self.note_images else ""
+        object.__setattr__(self, "images", images)
     
-    model_config = {
-        "populate_by_name": True,
-        # This allows using both original field names and aliases
-    }
\ No newline at end of file
+    @classmethod
+    def from_api(cls, note_data: Dict[str, Any]) -> "Note":
+        # Maps the API's field names (n_ans, n_imgs) onto the note fields; images
+        # become a tuple so the frozen note is really immutable and hashable
+        images = note_data.get("n_imgs")
+        return cls(
+            note=note_data["n_ans"],
+            note_images=tuple(images) if images is not None else None,
+        )
\ No newline at end of file
@@ -1,49 +1,110 @@
 import os
+import re
+import csv
+import json
+import time
+import hashlib
+import zipfile
+import tempfile
+import ijson
+import orjson
 import requests
-import pandas as pd
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import xlsxwriter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from operator import itemgetter
+from pathlib import Path
 import logging
-from typing import Dict, List, Any, Union
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Union
 from note import Note
 from helper import Helper
+from seen_notes import SeenNotes
 from dotenv import load_dotenv
 
-load_dotenv()
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 logger = logging.getLogger(__name__)
 
+NOTE_COLUMNS = ("topic_id", "note", "images")
+# Pulls a note dictionary's values out in column order as a tuple
+note_row = itemgetter(*NOTE_COLUMNS)
+
+# Numeric (not shared-string) value of the first data cell in a one-column sheet
+XLSX_DATE_CELL = re.compile(r'<c r="A2"(?![^>]*\bt=")[^>]*><v>([\d.]+)</v>')
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
 
 class NotesDataFetcher:
     """Fetches notes data from an API and processes it according to specified topic IDs."""
 
-    def __init__(self, config_path: str = "config.xlsx"):
+    def __init__(
+        self,
+        config_path: str = "config.json",
+        cache_dir: str = ".cache",
+        cache_ttl: int = 3600,
+        seen_db_path: Optional[str] = "seen_notes.db",
+    ):
         """Initialize the fetcher with paths and settings.
 
+        By default this opens (or creates) ``seen_notes.db`` in the current
+        directory, so ``extract_notes_by_topic_ids`` skips notes saved by any
+        earlier run there; pass ``seen_db_path=None`` to extract from the
+        response alone.
+
         Args:
-            config_path: Path to the Excel file containing the date configuration
+            config_path: Path to the JSON (or legacy Excel) file containing the date configuration
+            cache_dir: Directory where API responses are cached
+            cache_ttl: Seconds a cached API response stays valid (0 disables the cache)
+            seen_db_path: SQLite database of already saved notes (None disables deduplication)
         """
         self.config_path = config_path
+        self.cache_dir = Path(cache_dir)
+        self.cache_ttl = cache_ttl
+        # When the API was asked for the most recently read response
+        self.last_fetch_time: Optional[datetime] = None
         self.base_url = os.environ.get("API_BASE_URL", "")
         if not self.base_url:
             raise EnvironmentError("API_BASE_URL environment variable is not set")
 
+        # Retry transient failures with exponential backoff instead of failing the run
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+        )
+        # One session per fetcher so repeated requests reuse the pooled connection
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/json"})
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+
+        self.seen_notes = SeenNotes(seen_db_path) if seen_db_path else None
+
+    def __enter__(self) -> "NotesDataFetcher":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the HTTP session and the seen notes database."""
+        self.session.close()
+        if self.seen_notes is not None:
+            self.seen_notes.close()
+
     def read_input_date(self) -> str:
-        """Read the input date from the Excel configuration file.
+        """Read the input date from the configuration file.
 
         Returns:
             Formatted date string for API request
         """
         try:
-            df = pd.read_excel(self.config_path)
-            date_str = df.iloc[0, 0]  # Assuming date is in the first cell
-
-            # Convert to datetime if it's not already
-            if not isinstance(date_str, datetime):
-                date_str = pd.to_datetime(date_str)
+            if self.config_path.endswith(".xlsx"):
+                date_str = self._read_xlsx_date()
+            else:
+                with open(self.config_path, "r", encoding="utf-8") as f:
+                    date_str = datetime.fromisoformat(json.load(f)["LastFetchDate"])
 
             formatted_date = date_str.strftime("%Y-%m-%d %H:%M:%S")
             logger.info(f"Read input date: {formatted_date}")
@@ -52,9 +113,150 @@ class NotesDataFetcher:
             logger.error(f"Error reading input date: {e}")
             raise
 
+    def _read_xlsx_date(self) -> datetime:
+        """Read the date from a legacy Excel configuration file.
+
+        The date serial is pulled straight out of the sheet XML, which avoids
+        importing pandas; pandas is only used if the workbook isn't laid out
+        the way ``update_input_date`` writes it.
+
+        Returns:
+            Date stored in the first data cell
+        """
+        try:
+            with zipfile.ZipFile(self.config_path) as z:
+                xml = z.read("xl/worksheets/sheet1.xml").decode()
+            match = XLSX_DATE_CELL.search(xml)
+            if match:
+                serial = float(match.group(1))
+                return EXCEL_EPOCH + timedelta(milliseconds=round(serial * 86400000))
+        except (zipfile.BadZipFile, KeyError, ValueError) as e:
+            logger.warning(f"Falling back to pandas to read {self.config_path}: {e}")
+
+        import pandas as pd
+
+        # calamine parses the sheet in Rust instead of building openpyxl's DOM
+        df = pd.read_excel(self.config_path, engine="calamine")
+        date_str = df.iloc[0, 0]  # Assuming date is in the first cell
+
+        # Convert to datetime if it's not already
+        if not isinstance(date_str, datetime):
+            date_str = pd.to_datetime(date_str)
+        return date_str
+
+    def _is_cached(self, cache_path: Path) -> bool:
+        """Check whether a cached API response exists and is still fresh.
+
+        A stale cached response is deleted.
+
+        Args:
+            cache_path: Path of the cached JSON response
+
+        Returns:
+            True if the cached response can be used
+        """
+        if self.cache_ttl <= 0 or not cache_path.exists():
+            return False
+        if time.time() - cache_path.stat().st_mtime < self.cache_ttl:
+            return True
+        cache_path.unlink(missing_ok=True)
+        return False
+
+    def _prune_cache(self) -> None:
+        """Delete cached responses (and leftover temp files) older than ``cache_ttl``.
+
+        Every run asks for a new date, so old entries would never be reused.
+        """
+        cutoff = time.time() - max(self.cache_ttl, 0)
+        for path in self.cache_dir.iterdir():
+            if path.suffix in (".json", ".tmp") and path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+
+    def _cache_path(self, date_str: str) -> Path:
+        """Get the cache file path for an API response.
+
+        Args:
+            date_str: Formatted date string for the API request
+
+        Returns:
+            Path of the cached JSON response
+        """
+        key = hashlib.sha1(f"{self.base_url}|{date_str}".encode()).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    def _download(self, date_str: str, cache_path: Path) -> None:
+        """Download the API response for a date into the cache.
+
+        The body is streamed into a temporary file next to ``cache_path`` and
+        only moved into place once the download has finished, so an
+        interrupted transfer never becomes a cache entry. The file's mtime is
+        set to when the request was sent, which is how recent its data is.
+
+        Args:
+            date_str: Formatted date string for the API request
+            cache_path: Path the finished response is written to
+        """
+        url = f"{self.base_url}/get_notes_ankiconnect/{date_str}/False"
+        logger.info(f"Fetching data from: {url}")
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._prune_cache()
+        requested_at = time.time()
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, self.session.get(
+                url, timeout=30, stream=True
+            ) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+            os.utime(tmp_name, (requested_at, requested_at))
+            os.replace(tmp_name, cache_path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+
+    @contextmanager
+    def _response_file(self, date_str: str) -> Iterator[Path]:
+        """Provide the API response for a date as a file on disk.
+
+        A fresh cached response is reused; otherwise it is downloaded first.
+        ``last_fetch_time`` is set to when that response was requested from
+        the API, so a cached body isn't mistaken for current data. If the
+        caller fails to parse the file it is removed so the next run
+        fetches it again, and with the cache disabled it is always removed
+        after use.
+
+        Args:
+            date_str: Formatted date string for the API request
+
+        Yields:
+            Path of the JSON response
+        """
+        cache_path = self._cache_path(date_str)
+        if self._is_cached(cache_path):
+            logger.info(f"Using cached response: {cache_path}")
+        else:
+            self._download(date_str, cache_path)
+        self.last_fetch_time = datetime.fromtimestamp(cache_path.stat().st_mtime)
+
+        try:
+            yield cache_path
+        except (ijson.JSONError, orjson.JSONDecodeError):
+            cache_path.unlink(missing_ok=True)
+            raise
+        finally:
+            if self.cache_ttl <= 0:
+                cache_path.unlink(missing_ok=True)
+
     def fetch_data(self, date_str: str) -> Dict[str, Any]:
         """Fetch data from the API using the provided date.
 
+        Responses are cached on disk for ``cache_ttl`` seconds so that re-runs
+        for the same date don't hit the API again. The whole body is decoded
+        at once with orjson; ``process`` uses ``stream_topics`` instead so
+        memory stays bounded on large responses.
+
         Args:
             date_str: Formatted date string for the API request
 
@@ -62,50 +264,113 @@ class NotesDataFetcher:
             JSON response from the API
         """
         try:
-            url = f"{self.base_url}/get_notes_ankiconnect/{date_str}/False"
-            logger.info(f"Fetching data from: {url}")
+            with self._response_file(date_str) as path:
+                return orjson.loads(path.read_bytes())
+        except Exception as e:
+            logger.error(f"Error fetching data: {e}")
+            raise
+
+    def stream_topics(self, date_str: str) -> Iterator[Dict[str, Any]]:
+        """Stream the topics of the API response one at a time.
 
-            response = requests.get(url)
-            response.raise_for_status()
+        Unlike ``fetch_data`` the response is never fully materialized; topics
+        are parsed incrementally with ijson from the downloaded (or cached)
+        response file.
 
-            return response.json()
+        Args:
+            date_str: Formatted date string for the API request
+
+        Yields:
+            Topic dictionaries from the response's ``data`` array
+        """
+        try:
+            with self._response_file(date_str) as path, open(path, "rb") as f:
+                yield from ijson.items(f, "data.item", use_float=True)
         except Exception as e:
             logger.error(f"Error fetching data: {e}")
             raise
 
     def extract_notes_by_topic_ids(
-        self, data: Dict[str, Any], topic_ids: Union[str, List[str]]
+        self,
+        data: Union[Dict[str, Any], Iterable[Dict[str, Any]]],
+        topic_ids: Union[str, List[str]],
     ) -> List[Dict[str, Any]]:
         """Extract notes with specified topic IDs from the API response.
 
+        Notes repeated within the response are only extracted once, and notes
+        already recorded in ``seen_notes`` by a previous run are skipped.
+
         Args:
-            data: API response JSON
+            data: API response JSON, or an iterable of its topics (see ``stream_topics``)
             topic_ids: Single topic ID or list of topic IDs to filter by
 
         Returns:
             List of dictionaries containing note content and images
         """
-        # Normalize topic_ids to always be a list
-        if isinstance(topic_ids, str):
-            topic_ids = [topic_ids]
+        # Normalize topic_ids to a set for O(1) membership checks
+        topic_ids = {topic_ids} if isinstance(topic_ids, str) else set(topic_ids)
+
+        seen_notes = self.seen_notes
+        # Hashes of notes already saved or already kept during this call, so
+        # repeats within one response are dropped whether or not a database is used
+        skipped_keys = set()
+        add_skipped = skipped_keys.add
+        topics = data.get("data", ()) if isinstance(data, dict) else data
 
         filtered_notes = []
-        
-        for topic in data.get("data", []):
-            if topic.get("t_m_id") in topic_ids:
-                for note_data in topic.get("n_data", []):
-                    note_obj = Note(**note_data)
-                    filtered_notes.append({
-                        "topic_id": topic.get("t_m_id"),
-                        "note": note_obj.note, 
-                        "images": note_obj.images
-                    })
-
-        logger.info(f"Extracted {len(filtered_notes)} notes for topic IDs: {topic_ids}")
+        for topic in topics:
+            if (topic_id := topic.get("t_m_id")) not in topic_ids:
+                continue
+            notes = list(map(Note.from_api, topic.get("n_data", ())))
+            keys = [SeenNotes.key(topic_id, note.note) for note in notes]
+            if seen_notes is not None:
+                skipped_keys.update(seen_notes.seen(keys))
+
+            # set.add returns None, so "not add(key)" records the key while keeping the note
+            filtered_notes += [
+                {"topic_id": topic_id, "note": note.note, "images": note.images}
+                for key, note in zip(keys, notes)
+                if key not in skipped_keys and not add_skipped(key)
+            ]
+
+        logger.info(f"Extracted {len(filtered_notes)} notes for topic IDs: {sorted(topic_ids)}")
         return filtered_notes
 
+    def save_to_file(
+        self,
+        notes: List[Dict[str, Any]],
+        topic_ids: List[str],
+        output_format: str = "csv",
+        output_path: Optional[str] = None,
+    ) -> None:
+        """Save the extracted notes as CSV, TSV or Excel.
+
+        Args:
+            notes: List of dictionaries containing note data
+            topic_ids: Topic IDs used to name the output file
+            output_format: One of "csv", "tsv" or "xlsx"; ignored if output_path is given
+            output_path: Path to save the output file; its suffix picks the format
+        """
+        if not output_path:
+            output_path = Helper.get_output_path(topic_ids, output_format)
+
+        if output_path.endswith(".xlsx"):
+            self.save_to_excel(notes, topic_ids, output_path)
+            return
+
+        try:
+            delimiter = "\t" if output_path.endswith(".tsv") else ","
+            with open(output_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f, delimiter=delimiter)
+                writer.writerow(NOTE_COLUMNS)
+                writer.writerows(map(note_row, notes))
+            logger.info(f"Saved {len(notes)} notes to {output_path}")
+        except Exception as e:
+            logger.error(f"Error saving to file: {e}")
+            raise
+
     def save_to_excel(
-        self, notes: List[Dict[str, Any]], topic_ids: List[str], output_path: str = None
+        self, notes: List[Dict[str, Any]], topic_ids: List[str], output_path: Optional[str] = None
     ) -> None:
         """Save the extracted notes to an Excel file.
 
@@ -114,43 +379,91 @@ class NotesDataFetcher:
             output_path: Path to save the output Excel file
         """
         if not output_path:
-            output_path = Helper.get_output_path(topic_ids)
+            output_path = Helper.get_output_path(topic_ids, "xlsx")
             
         try:
-            df = pd.DataFrame(notes)
-            df.to_excel(output_path, index=False)
+            # constant_memory flushes each row to disk as soon as the next one starts
+            wb = xlsxwriter.Workbook(
+                output_path, {"constant_memory": True, "strings_to_urls": False}
+            )
+            try:
+                ws = wb.add_worksheet("notes")
+
+                # Style the header the same way pandas' to_excel did
+                header_format = wb.add_format(
+                    {"bold": True, "border": 1, "align": "center", "valign": "top"}
+                )
+                ws.write_row(0, 0, NOTE_COLUMNS, header_format)
+
+                for row, values in enumerate(map(note_row, notes), 1):
+                    ws.write_row(row, 0, values)
+            finally:
+                # Always release the constant_memory temp file
+                wb.close()
             logger.info(f"Saved {len(notes)} notes to {output_path}")
         except Exception as e:
+            # close() writes whatever rows were flushed; don't leave a truncated workbook
+            Path(output_path).unlink(missing_ok=True)
             logger.error(f"Error saving to Excel: {e}")
             raise
 
-    def update_input_date(self, current_date: datetime = datetime.now()) -> None:
-        """Update the input date in the config file to the current date."""
+    def update_input_date(self, current_date: Optional[datetime] = None) -> None:
+        """Update the input date in the config file to the current date.
+
+        Args:
+            current_date: Date to store; defaults to the time of the call
+        """
+        if current_date is None:
+            current_date = datetime.now()
+
         try:
-            df = pd.DataFrame({"LastFetchDate": [current_date]})
-            df.to_excel(self.config_path, index=False)
+            if self.config_path.endswith(".xlsx"):
+                import pandas as pd
+
+                df = pd.DataFrame({"LastFetchDate": [current_date]})
+                df.to_excel(self.config_path, index=False)
+            else:
+                with open(self.config_path, "w", encoding="utf-8") as f:
+                    json.dump({"LastFetchDate": current_date.isoformat()}, f)
             logger.info(f"Updated input date to: {current_date}")
         except Exception as e:
             logger.error(f"Error updating input date: {e}")
             raise
 
-    def process(self, topic_ids: Union[str, List[str]] = "TDS") -> None:
+    def process(
+        self, topic_ids: Union[str, List[str]] = "TDS", output_format: str = "csv"
+    ) -> None:
         """Run the complete data fetching and processing workflow.
         
         Args:
             topic_ids: Single topic ID or list of topic IDs to filter by
+            output_format: Output file format, one of "csv", "tsv" or "xlsx"
         """
         input_date = self.read_input_date()
-        api_data = self.fetch_data(input_date)
-        filtered_notes = self.extract_notes_by_topic_ids(api_data, topic_ids)
-        self.save_to_excel(filtered_notes, topic_ids)
-        self.update_input_date()
+        self.last_fetch_time = None
+        # One request returns every topic for the date, so topic_ids are filtered
+        # client-side; the API has no per-topic endpoint to fetch concurrently
+        topics = self.stream_topics(input_date)
+        filtered_notes = self.extract_notes_by_topic_ids(topics, topic_ids)
+        self.save_to_file(filtered_notes, topic_ids, output_format)
+        if self.seen_notes is not None:
+            self.seen_notes.add(filtered_notes)
+        # Resume from when the response was requested, not from now: a cached
+        # response from a failed earlier run doesn't cover the time since then
+        self.update_input_date(self.last_fetch_time)
         logger.info("Process completed successfully")
 
 
 def main():
     """Main entry point of the script."""
     import argparse
+
+    load_dotenv()
+
+    # Configure logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
     
     parser = argparse.ArgumentParser(description="Fetch and process notes data.")
     parser.add_argument(
@@ -159,12 +472,18 @@ def main():
         default=["TDS"],
         help="One or more topic IDs to filter notes by (default: 'TDS')"
     )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "tsv", "xlsx"],
+        default="csv",
+        help="Output file format (default: 'csv')"
+    )
     
     args = parser.parse_args()
     
     try:
-        fetcher = NotesDataFetcher()
-        fetcher.process(args.topic_ids)
+        with NotesDataFetcher() as fetcher:
+            fetcher.process(args.topic_ids, args.format)
     except Exception as e:
         logger.error(f"Process failed: {e}")
         raise
@@ -0,0 +1,70 @@
+import hashlib
+import sqlite3
+from typing import Any, Dict, Iterable, List, Set
+
+
+# Stays under SQLite's default limit on bound parameters per statement
+QUERY_BATCH_SIZE = 500
+
+
+class SeenNotes:
+    """Remembers notes that were already saved so overlapping fetches can skip them."""
+
+    def __init__(self, db_path: str = "seen_notes.db"):
+        """Open (or create) the SQLite database of seen note hashes.
+
+        Args:
+            db_path: Path to the SQLite database file
+        """
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen_notes (hash BLOB PRIMARY KEY)"
+        )
+
+    @staticmethod
+    def key(topic_id: str, note: str) -> bytes:
+        """Hash a note by its topic ID and content.
+
+        Returns:
+            16-byte blake2b digest identifying the note
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(topic_id.encode())
+        digest.update(b"\0")
+        digest.update(note.encode())
+        return digest.digest()
+
+    def seen(self, keys: List[bytes]) -> Set[bytes]:
+        """Look up which of the given note hashes are already stored.
+
+        Args:
+            keys: Note hashes as returned by ``key``
+
+        Returns:
+            The subset of keys that were seen before
+        """
+        found = set()
+        for start in range(0, len(keys), QUERY_BATCH_SIZE):
+            batch = keys[start:start + QUERY_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"SELECT hash FROM seen_notes WHERE hash IN ({placeholders})", batch
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def add(self, notes: Iterable[Dict[str, Any]]) -> None:
+        """Mark notes as seen.
+
+        Args:
+            notes: Extracted note dictionaries with topic_id and note keys
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO seen_notes (hash) VALUES (?)",
+                ((self.key(note["topic_id"], note["note"]),) for note in notes),
+            )
+
+    def close(self) -> None:
+        """Close the database connection."""
+        self.connection.close()
@@ -1,10 +1,17 @@
 import os
+import json
+import ijson
 import pytest
 import pandas as pd
+from python_calamine import CalamineWorkbook
 from datetime import datetime
+from dataclasses import FrozenInstanceError
 from unittest.mock import patch, MagicMock, mock_open
 import requests
+import xlsxwriter
 from notes_data_fetcher import NotesDataFetcher
+from note import Note
+from seen_notes import SeenNotes
 
 
 @pytest.fixture
@@ -14,6 +21,29 @@ def mock_env_variables():
         yield
 
 
+def mock_streamed_response(*chunks):
+    """Build a mock streamed response whose body is delivered as chunks.
+
+    An exception among the chunks is raised at that point of the download.
+    """
+    def iter_content(chunk_size=None):
+        for chunk in chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    mock_response = MagicMock()
+    mock_response.__enter__.return_value = mock_response
+    mock_response.iter_content.side_effect = iter_content
+    return mock_response
+
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(tmp_path, monkeypatch):
+    """Fixture to keep files written relative to the cwd (e.g. the API cache) out of the repo."""
+    monkeypatch.chdir(tmp_path)
+
+
 @pytest.fixture
 def sample_config_data():
     """Fixture for sample configuration data."""
@@ -64,39 +94,195 @@ class TestNotesDataFetcher:
         """Test successful initialization with environment variables set."""
         fetcher = NotesDataFetcher()
         assert fetcher.base_url == "https://test-api.example.com"
-        assert fetcher.config_path == "config.xlsx"
+        assert fetcher.config_path == "config.json"
+
+    def test_context_manager_closes_session(self, mock_env_variables):
+        """Test the HTTP session is closed when leaving the context manager."""
+        with patch("requests.Session.close") as mock_close:
+            with NotesDataFetcher() as fetcher:
+                assert fetcher.session.headers["Accept"] == "application/json"
+            mock_close.assert_called_once()
 
     def test_read_input_date(self, mock_env_variables, sample_config_data):
         """Test reading input date from configuration file."""
+        # Not a valid workbook, so the pandas fallback is used
+        open("config.xlsx", "wb").close()
         with patch("pandas.read_excel", return_value=sample_config_data):
-            fetcher = NotesDataFetcher()
+            fetcher = NotesDataFetcher("config.xlsx")
             date_str = fetcher.read_input_date()
             assert date_str == "2023-01-01 12:00:00"
 
     def test_read_input_date_error(self, mock_env_variables):
         """Test error handling when reading input date fails."""
+        open("config.xlsx", "wb").close()
         with patch("pandas.read_excel", side_effect=Exception("Read error")):
-            fetcher = NotesDataFetcher()
+            fetcher = NotesDataFetcher("config.xlsx")
             with pytest.raises(Exception, match="Read error"):
                 fetcher.read_input_date()
 
+    def test_read_input_date_xlsx_without_pandas(self, mock_env_variables):
+        """Test the date is read from the sheet XML without going through pandas."""
+        fetcher = NotesDataFetcher("config.xlsx")
+        fetcher.update_input_date(datetime(2023, 1, 1, 12, 0, 0))
+
+        with patch("pandas.read_excel", side_effect=AssertionError("pandas used")):
+            assert fetcher.read_input_date() == "2023-01-01 12:00:00"
+
+    def test_json_config_round_trip(self, mock_env_variables, tmp_path):
+        """Test updating and reading back the date from a JSON config file."""
+        config_path = str(tmp_path / "config.json")
+        fetcher = NotesDataFetcher(config_path)
+        fetcher.update_input_date(datetime(2023, 1, 1, 12, 0, 0))
+
+        assert fetcher.read_input_date() == "2023-01-01 12:00:00"
+
     def test_fetch_data(self, mock_env_variables):
         """Test fetching data from API."""
-        mock_response = MagicMock()
-        mock_response.json.return_value = {"data": []}
+        mock_response = mock_streamed_response(b'{"data": []}')
         
-        with patch("requests.get", return_value=mock_response) as mock_get:
+        with patch("requests.Session.get", return_value=mock_response) as mock_get:
             fetcher = NotesDataFetcher()
             result = fetcher.fetch_data("2023-01-01 12:00:00")
             
             mock_get.assert_called_once_with(
-                "https://test-api.example.com/get_notes_ankiconnect/2023-01-01 12:00:00/False"
+                "https://test-api.example.com/get_notes_ankiconnect/2023-01-01 12:00:00/False",
+                timeout=30,
+                stream=True,
             )
             assert result == {"data": []}
 
+    def test_session_retries_transient_errors(self, mock_env_variables):
+        """Test the HTTP session is configured to retry transient failures."""
+        fetcher = NotesDataFetcher()
+        retry = fetcher.session.get_adapter("https://test-api.example.com").max_retries
+
+        assert retry.total == 5
+        assert 503 in retry.status_forcelist
+
+    def test_fetch_data_cached(self, mock_env_variables):
+        """Test a repeated fetch for the same date is served from the cache."""
+        with patch("requests.Session.get",
+                   side_effect=lambda *args, **kwargs: mock_streamed_response(b'{"data": []}')) as mock_get:
+            fetcher = NotesDataFetcher()
+            fetcher.fetch_data("2023-01-01 12:00:00")
+            result = fetcher.fetch_data("2023-01-01 12:00:00")
+
+            mock_get.assert_called_once()
+            assert result == {"data": []}
+
+    def test_fetch_data_cache_disabled(self, mock_env_variables):
+        """Test a zero TTL always hits the API."""
+        with patch("requests.Session.get",
+                   side_effect=lambda *args, **kwargs: mock_streamed_response(b'{"data": []}')) as mock_get:
+            fetcher = NotesDataFetcher(cache_ttl=0)
+            fetcher.fetch_data("2023-01-01 12:00:00")
+            fetcher.fetch_data("2023-01-01 12:00:00")
+
+            assert mock_get.call_count == 2
+            assert list(fetcher.cache_dir.iterdir()) == []
+
+    def test_stream_topics(self, mock_env_variables, sample_api_response):
+        """Test streaming topics caches the response and parses it incrementally."""
+        mock_response = mock_streamed_response(json.dumps(sample_api_response).encode())
+
+        with patch("requests.Session.get", return_value=mock_response) as mock_get:
+            fetcher = NotesDataFetcher()
+            topics = list(fetcher.stream_topics("2023-01-01 12:00:00"))
+            cached_topics = list(fetcher.stream_topics("2023-01-01 12:00:00"))
+
+            mock_get.assert_called_once()
+            assert topics == sample_api_response["data"]
+            assert cached_topics == topics
+
+    def test_stream_topics_cache_disabled(self, mock_env_variables, sample_api_response):
+        """Test streaming topics without a cache leaves no response file behind."""
+        mock_response = mock_streamed_response(json.dumps(sample_api_response).encode())
+
+        with patch("requests.Session.get", return_value=mock_response):
+            fetcher = NotesDataFetcher(cache_ttl=0)
+            notes = fetcher.extract_notes_by_topic_ids(
+                fetcher.stream_topics("2023-01-01 12:00:00"), "TDS"
+            )
+
+            assert [note["note"] for note in notes] == ["Test note 1", "Test note 2"]
+            assert list(fetcher.cache_dir.iterdir()) == []
+
+    def test_stream_topics_truncated_download_not_cached(self, mock_env_variables, sample_api_response):
+        """Test a download that drops partway is not cached and the retry hits the API."""
+        body = json.dumps(sample_api_response).encode()
+        responses = [
+            mock_streamed_response(body[:20], requests.exceptions.ChunkedEncodingError("dropped")),
+            mock_streamed_response(body[:20], body[20:]),
+        ]
+
+        with patch("requests.Session.get", side_effect=responses) as mock_get:
+            fetcher = NotesDataFetcher()
+            with pytest.raises(requests.exceptions.ChunkedEncodingError):
+                list(fetcher.stream_topics("2023-01-01 12:00:00"))
+            assert list(fetcher.cache_dir.iterdir()) == []
+
+            topics = list(fetcher.stream_topics("2023-01-01 12:00:00"))
+
+            assert mock_get.call_count == 2
+            assert topics == sample_api_response["data"]
+
+    def test_stream_topics_invalid_json_not_cached(self, mock_env_variables, sample_api_response):
+        """Test a non-JSON body is dropped from the cache once parsing fails."""
+        responses = [
+            mock_streamed_response(b"<html>Down for maintenance</html>"),
+            mock_streamed_response(json.dumps(sample_api_response).encode()),
+        ]
+
+        with patch("requests.Session.get", side_effect=responses) as mock_get:
+            fetcher = NotesDataFetcher()
+            with pytest.raises(ijson.JSONError):
+                list(fetcher.stream_topics("2023-01-01 12:00:00"))
+
+            topics = list(fetcher.stream_topics("2023-01-01 12:00:00"))
+
+            assert mock_get.call_count == 2
+            assert topics == sample_api_response["data"]
+
+    def test_fetch_data_prunes_stale_cache(self, mock_env_variables):
+        """Test expired cache entries are deleted when a new response is downloaded."""
+        fetcher = NotesDataFetcher()
+        fetcher.cache_dir.mkdir()
+        stale = fetcher.cache_dir / "stale.json"
+        stale.write_bytes(b"{}")
+        os.utime(stale, (0, 0))
+
+        with patch("requests.Session.get", return_value=mock_streamed_response(b'{"data": []}')):
+            fetcher.fetch_data("2023-01-01 12:00:00")
+
+        assert not stale.exists()
+        assert len(list(fetcher.cache_dir.iterdir())) == 1
+
+    def test_process_retry_resumes_from_cached_fetch_time(self, mock_env_variables, sample_api_response):
+        """Test a retry served from the cache stores the original fetch time, not now."""
+        fetcher = NotesDataFetcher()
+        fetcher.update_input_date(datetime(2023, 1, 1, 12, 0, 0))
+        body = json.dumps(sample_api_response).encode()
+
+        with patch("requests.Session.get", return_value=mock_streamed_response(body)) as mock_get:
+            with patch.object(NotesDataFetcher, "save_to_file", side_effect=Exception("Save error")):
+                with pytest.raises(Exception, match="Save error"):
+                    fetcher.process()
+            # Pretend the failed run fetched a minute ago
+            fetched_at = int(datetime.now().timestamp()) - 60
+            cache_file, = fetcher.cache_dir.iterdir()
+            os.utime(cache_file, (fetched_at, fetched_at))
+
+            with patch.object(NotesDataFetcher, "save_to_file"):
+                fetcher.process()
+
+            mock_get.assert_called_once()
+        with open("config.json", encoding="utf-8") as f:
+            stored = datetime.fromisoformat(json.load(f)["LastFetchDate"])
+        assert stored == datetime.fromtimestamp(fetched_at)
+
     def test_fetch_data_error(self, mock_env_variables):
         """Test error handling when API request fails."""
-        with patch("requests.get", side_effect=requests.exceptions.RequestException("API error")):
+        with patch("requests.Session.get", side_effect=requests.exceptions.RequestException("API error")):
             fetcher = NotesDataFetcher()
             with pytest.raises(Exception, match="API error"):
                 fetcher.fetch_data("2023-01-01 12:00:00")
@@ -104,7 +290,7 @@ class TestNotesDataFetcher:
     def test_extract_tds_notes(self, mock_env_variables, sample_api_response):
         """Test extracting TDS notes from API response."""
         fetcher = NotesDataFetcher()
-        notes = fetcher.extract_tds_notes(sample_api_response)
+        notes = fetcher.extract_notes_by_topic_ids(sample_api_response, "TDS")
         
         assert len(notes) == 2
         assert notes[0]["note"] == "Test note 1"
@@ -112,42 +298,135 @@ class TestNotesDataFetcher:
         assert notes[1]["note"] == "Test note 2"
         assert notes[1]["images"] == ""
 
+    def test_note_from_api(self):
+        """Test building a Note from an API note payload."""
+        note = Note.from_api({"n_ans": "Test note", "n_imgs": ["a.jpg", "b.jpg"], "extra": 1})
+        assert note.note == "Test note"
+        assert note.images == "a.jpg, b.jpg"
+        assert Note.from_api({"n_ans": "No images"}).images == ""
+
+        with pytest.raises(FrozenInstanceError):
+            note.note = "Changed"
+        assert note.note_images == ("a.jpg", "b.jpg")
+        assert hash(note) == hash(Note.from_api({"n_ans": "Test note", "n_imgs": ["a.jpg", "b.jpg"]}))
+
+    def test_extract_notes_multiple_topic_ids(self, mock_env_variables, sample_api_response):
+        """Test extracting notes for several topic IDs at once."""
+        fetcher = NotesDataFetcher()
+        notes = fetcher.extract_notes_by_topic_ids(sample_api_response, ["TDS", "OTHER"])
+
+        assert [note["topic_id"] for note in notes] == ["TDS", "TDS", "OTHER"]
+        assert notes[2]["note"] == "Non-TDS note"
+
+    def test_extract_skips_seen_notes(self, mock_env_variables, sample_api_response):
+        """Test notes saved by an earlier run are not extracted again."""
+        fetcher = NotesDataFetcher()
+        fetcher.seen_notes.add([{"topic_id": "TDS", "note": "Test note 1"}])
+        notes = fetcher.extract_notes_by_topic_ids(sample_api_response, "TDS")
+
+        assert [note["note"] for note in notes] == ["Test note 2"]
+
+    @pytest.mark.parametrize("seen_db_path", ["seen_notes.db", None])
+    def test_extract_skips_repeated_notes(self, mock_env_variables, seen_db_path):
+        """Test a note repeated within one response is only extracted once, with or without a database."""
+        data = {
+            "data": [
+                {"t_m_id": "TDS", "n_data": [{"n_ans": "Repeated"}, {"n_ans": "Repeated"}]},
+                {"t_m_id": "TDS", "n_data": [{"n_ans": "Repeated"}, {"n_ans": "Other"}]},
+            ]
+        }
+        fetcher = NotesDataFetcher(seen_db_path=seen_db_path)
+        notes = fetcher.extract_notes_by_topic_ids(data, "TDS")
+
+        assert [note["note"] for note in notes] == ["Repeated", "Other"]
+
+    def test_seen_notes_batches_lookups(self, mock_env_variables):
+        """Test looking up more hashes than fit in one query."""
+        fetcher = NotesDataFetcher()
+        notes = [{"topic_id": "TDS", "note": f"Note {i}"} for i in range(1200)]
+        fetcher.seen_notes.add(notes[::2])
+        keys = [SeenNotes.key(note["topic_id"], note["note"]) for note in notes]
+
+        assert fetcher.seen_notes.seen(keys) == set(keys[::2])
+
+    def test_extract_without_seen_notes(self, mock_env_variables, sample_api_response):
+        """Test deduplication is disabled without a seen notes database."""
+        fetcher = NotesDataFetcher(seen_db_path=None)
+        assert len(fetcher.extract_notes_by_topic_ids(sample_api_response, "TDS")) == 2
+        assert not os.path.exists("seen_notes.db")
+
     def test_extract_tds_notes_empty(self, mock_env_variables):
         """Test extracting TDS notes from empty API response."""
         fetcher = NotesDataFetcher()
-        notes = fetcher.extract_tds_notes({"data": []})
+        notes = fetcher.extract_notes_by_topic_ids({"data": []}, "TDS")
         assert notes == []
 
-    def test_save_to_excel(self, mock_env_variables):
+    def test_save_to_excel(self, mock_env_variables, tmp_path):
         """Test saving notes to Excel file."""
         test_notes = [
-            {"n_ans": "Note 1", "n_imgs": ["img1.jpg"]},
-            {"n_ans": "Note 2", "n_imgs": []}
+            {"topic_id": "TDS", "note": "Note 1", "images": "img1.jpg"},
+            {"topic_id": "TDS", "note": "Note 2", "images": ""}
         ]
-        
-        with patch("pandas.DataFrame.to_excel") as mock_to_excel:
-            fetcher = NotesDataFetcher()
-            fetcher.save_to_excel(test_notes, "test_output.xlsx")
-            
-            mock_to_excel.assert_called_once()
-            # Verify DataFrame content by checking the call's first argument
-            df_arg = mock_to_excel.call_args[0][0]
-            assert df_arg == "test_output.xlsx"
+        output_path = str(tmp_path / "test_output.xlsx")
+
+        fetcher = NotesDataFetcher()
+        fetcher.save_to_excel(test_notes, ["TDS"], output_path)
+
+        rows = CalamineWorkbook.from_path(output_path).get_sheet_by_name("notes").to_python()
+        assert rows[0] == ["topic_id", "note", "images"]
+        assert rows[1] == ["TDS", "Note 1", "img1.jpg"]
+        assert rows[2] == ["TDS", "Note 2", ""]
 
     def test_save_to_excel_error(self, mock_env_variables):
         """Test error handling when saving to Excel fails."""
-        with patch("pandas.DataFrame.to_excel", side_effect=Exception("Save error")):
+        with patch("xlsxwriter.Workbook.close", side_effect=Exception("Save error")):
             with patch("notes_data_fetcher.Helper.get_output_path", return_value="test_output.xlsx"):
                 fetcher = NotesDataFetcher()
                 with pytest.raises(Exception, match="Save error"):
-                    fetcher.save_to_excel([])
+                    fetcher.save_to_excel([], ["TDS"])
+
+    def test_save_to_excel_closes_workbook_on_error(self, mock_env_variables):
+        """Test the workbook is still closed when writing a row fails."""
+        real_close = xlsxwriter.Workbook.close
+        with patch("xlsxwriter.worksheet.Worksheet.write_row", side_effect=Exception("Write error")), \
+                patch.object(xlsxwriter.Workbook, "close", autospec=True, side_effect=real_close) as mock_close:
+            fetcher = NotesDataFetcher()
+            with pytest.raises(Exception, match="Write error"):
+                fetcher.save_to_excel([], ["TDS"], "test_output.xlsx")
+
+            mock_close.assert_called_once()
+            assert not os.path.exists("test_output.xlsx")
+
+    def test_save_to_file_csv(self, mock_env_variables, tmp_path):
+        """Test saving notes to a CSV file."""
+        test_notes = [
+            {"topic_id": "TDS", "note": "Note 1", "images": "img1.jpg, img2.jpg"}
+        ]
+        output_path = tmp_path / "test_output.csv"
+
+        fetcher = NotesDataFetcher()
+        fetcher.save_to_file(test_notes, ["TDS"], output_path=str(output_path))
+
+        assert output_path.read_text(encoding="utf-8").splitlines() == [
+            "topic_id,note,images",
+            'TDS,Note 1,"img1.jpg, img2.jpg"',
+        ]
+
+    def test_save_to_file_xlsx(self, mock_env_variables):
+        """Test the xlsx format is delegated to save_to_excel."""
+        with patch("notes_data_fetcher.Helper.get_output_path", return_value="test_output.xlsx"), \
+                patch.object(NotesDataFetcher, "save_to_excel") as mock_save_to_excel:
+            fetcher = NotesDataFetcher()
+            fetcher.save_to_file([], ["TDS"], "xlsx")
+
+            mock_save_to_excel.assert_called_once_with([], ["TDS"], "test_output.xlsx")
 
     def test_update_input_date(self, mock_env_variables):
         """Test updating input date in config file."""
         with patch("pandas.DataFrame.to_excel") as mock_to_excel:
             current_time = datetime.now()
             
-            fetcher = NotesDataFetcher()
+            fetcher = NotesDataFetcher("config.xlsx")
             fetcher.update_input_date(current_time)
             
             mock_to_excel.assert_called_once()
@@ -155,14 +434,24 @@ class TestNotesDataFetcher:
             df_arg = mock_to_excel.call_args[1]["index"]
             assert df_arg is False
 
+    def test_update_input_date_defaults_to_call_time(self, mock_env_variables):
+        """Test the default date is taken when the method is called, not at import."""
+        fetcher = NotesDataFetcher()
+        before = datetime.now()
+        fetcher.update_input_date()
+
+        with open("config.json", encoding="utf-8") as f:
+            stored = datetime.fromisoformat(json.load(f)["LastFetchDate"])
+        assert stored >= before
+
     def test_process_success(self, mock_env_variables, sample_config_data, sample_api_response):
         """Test the full processing workflow."""
         with patch.multiple(
             NotesDataFetcher,
             read_input_date=MagicMock(return_value="2023-01-01 12:00:00"),
-            fetch_data=MagicMock(return_value=sample_api_response),
-            extract_tds_notes=MagicMock(return_value=[{"n_ans": "Test", "n_imgs": []}]),
-            save_to_excel=MagicMock(),
+            stream_topics=MagicMock(return_value=sample_api_response["data"]),
+            extract_notes_by_topic_ids=MagicMock(return_value=[{"topic_id": "TDS", "note": "Test", "images": ""}]),
+            save_to_file=MagicMock(),
             update_input_date=MagicMock()
         ):
             fetcher = NotesDataFetcher()
@@ -170,22 +459,50 @@ class TestNotesDataFetcher:
             
             # Verify each method was called once with correct parameters
             fetcher.read_input_date.assert_called_once()
-            fetcher.fetch_data.assert_called_once_with("2023-01-01 12:00:00")
-            fetcher.extract_tds_notes.assert_called_once_with(sample_api_response)
-            fetcher.save_to_excel.assert_called_once_with([{"n_ans": "Test", "n_imgs": []}])
+            fetcher.stream_topics.assert_called_once_with("2023-01-01 12:00:00")
+            fetcher.extract_notes_by_topic_ids.assert_called_once_with(sample_api_response["data"], "TDS")
+            fetcher.save_to_file.assert_called_once_with(
+                [{"topic_id": "TDS", "note": "Test", "images": ""}], "TDS", "csv"
+            )
             fetcher.update_input_date.assert_called_once()
 
+    def test_process_marks_notes_seen(self, mock_env_variables, sample_api_response):
+        """Test a second run over the same data extracts nothing new."""
+        with patch.multiple(
+            NotesDataFetcher,
+            read_input_date=MagicMock(return_value="2023-01-01 12:00:00"),
+            stream_topics=MagicMock(return_value=sample_api_response["data"]),
+            save_to_file=MagicMock(),
+            update_input_date=MagicMock()
+        ):
+            fetcher = NotesDataFetcher()
+            fetcher.process()
+            fetcher.process()
+
+            assert len(fetcher.save_to_file.call_args_list[0][0][0]) == 2
+            assert fetcher.save_to_file.call_args_list[1][0][0] == []
+
     def test_main_function(self, mock_env_variables):
         """Test the main function."""
-        with patch("notes_data_fetcher.NotesDataFetcher.process") as mock_process:
+        with patch("notes_data_fetcher.NotesDataFetcher.process") as mock_process, \
+                patch("sys.argv", ["notes_data_fetcher.py"]):
+            from notes_data_fetcher import main
+            main()
+            mock_process.assert_called_once_with(["TDS"], "csv")
+
+    def test_main_function_format(self, mock_env_variables):
+        """Test the --format flag is passed through to process."""
+        with patch("notes_data_fetcher.NotesDataFetcher.process") as mock_process, \
+                patch("sys.argv", ["notes_data_fetcher.py", "--topic-ids", "A", "B", "--format", "xlsx"]):
             from notes_data_fetcher import main
             main()
-            mock_process.assert_called_once()
+            mock_process.assert_called_once_with(["A", "B"], "xlsx")
 
     def test_main_function_error(self, mock_env_variables):
         """Test error handling in main function."""
         with patch("notes_data_fetcher.NotesDataFetcher.process", 
-                   side_effect=Exception("Process error")):
+                   side_effect=Exception("Process error")), \
+                patch("sys.argv", ["notes_data_fetcher.py"]):
             from notes_data_fetcher import main
             with pytest.raises(Exception, match="Process error"):
                 main()
\ No newline at end of file